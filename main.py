@@ -1,42 +1,101 @@
 import os
+import json
+import logging
 import uuid
+import hashlib
 import shutil
+import asyncio
 import subprocess
-import mimetypes
+import tempfile
+import time
+import importlib.util
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from glob import escape as glob_escape
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
 
+import aiofiles
 from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 
 try:
-    import filetype
-    HAS_FILETYPE = True
+    import fcntl
 except ImportError:
-    HAS_FILETYPE = False
+    fcntl = None
 
 try:
     from PIL import Image
+    # Oversized inputs are rejected explicitly against MAX_IMAGE_PIXELS instead
+    Image.MAX_IMAGE_PIXELS = None
     HAS_PILLOW = True
 except ImportError:
     HAS_PILLOW = False
 
+try:
+    import pyvips
+    HAS_VIPS = True
+except (ImportError, OSError):
+    HAS_VIPS = False
+
 try:
     import pandas as pd
     HAS_PANDAS = True
 except ImportError:
     HAS_PANDAS = False
 
+# Faster pandas I/O engines, used when installed (checked without importing them)
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+HAS_CALAMINE = importlib.util.find_spec("python_calamine") is not None
+HAS_XLSXWRITER = importlib.util.find_spec("xlsxwriter") is not None
+
+try:
+    import pymupdf as fitz
+    HAS_FITZ = True
+except ImportError:
+    HAS_FITZ = False
+
 try:
     import pypdfium2 as pdfium
     HAS_PDFIUM = True
 except ImportError:
     HAS_PDFIUM = False
 
-app = FastAPI(title="Universal File Converter")
+try:
+    from blake3 import blake3
+    HAS_BLAKE3 = True
+except ImportError:
+    HAS_BLAKE3 = False
+
+try:
+    from unoserver.client import UnoClient
+    HAS_UNOSERVER = True
+except ImportError:
+    HAS_UNOSERVER = False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    detect_hwaccel()
+    start_conversion_pool()
+    start_office_servers()
+    try:
+        yield
+    finally:
+        stop_office_servers()
+        stop_conversion_pool()
+
+
+app = FastAPI(title="Universal File Converter", lifespan=lifespan)
 
 allowed_origins_raw = os.getenv(
     "ALLOWED_ORIGINS",
@@ -56,8 +115,120 @@ app.add_middleware(
 
 UPLOAD_DIR = Path("uploads")
 OUTPUT_DIR = Path("outputs")
+CACHE_DIR = OUTPUT_DIR / "cache"
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
+CACHE_DIR.mkdir(exist_ok=True)
+
+logger = logging.getLogger(__name__)
+
+# Persistent LibreOffice instances (one unoserver each) per app worker process.
+# Each worker claims its own slot of ports so `uvicorn --workers N` does not
+# start N servers on the same ports.
+LIBREOFFICE_INSTANCES = int(os.getenv("LIBREOFFICE_INSTANCES", "1"))
+UNOSERVER_BASE_PORT = int(os.getenv("UNOSERVER_BASE_PORT", "2003"))
+OFFICE_MAX_SLOTS = 64
+# A conversion taking longer is killed; unoserver then exits and is restarted
+OFFICE_CONVERSION_TIMEOUT = 120
+# A server dying sooner than this after start is broken, not just crashed
+OFFICE_MIN_UPTIME = 30
+
+# Let nginx send converted files: respond with X-Accel-Redirect to an internal
+# location that maps onto OUTPUT_DIR instead of streaming through Python
+USE_XACCEL = os.getenv("USE_XACCEL") == "1"
+XACCEL_PREFIX = os.getenv("XACCEL_PREFIX", "/internal/outputs/")
+
+# Worker processes for CPU-bound conversions (images, spreadsheets, PDF rendering).
+# Each app worker gets its own pool, so the default splits the CPUs across
+# WEB_CONCURRENCY (uvicorn's default for --workers)
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+CONVERSION_WORKERS = int(os.getenv(
+    "CONVERSION_WORKERS", str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))
+))
+
+# Max ffmpeg processes running at once
+MEDIA_CONCURRENCY = int(os.getenv("MEDIA_CONCURRENCY", str(os.cpu_count() or 1)))
+media_semaphore = asyncio.Semaphore(MEDIA_CONCURRENCY)
+
+# Encoder settings for common audio targets
+MEDIA_CODEC_ARGS = {
+    "wav": ["-c:a", "pcm_s16le"],
+    "mp3": ["-c:a", "libmp3lame", "-q:a", "2"],
+}
+
+# Container changes that can keep the original streams (ffmpeg -c copy)
+REMUX_PAIRS = {
+    ("mkv", "mp4"), ("mkv", "mov"), ("mkv", "webm"),
+    ("mov", "mp4"), ("mov", "mkv"),
+    ("mp4", "mov"), ("mp4", "mkv"),
+    ("webm", "mkv"),
+}
+
+# Codecs each target container can hold as-is; None accepts anything
+REMUX_CODECS = {
+    "mp4": frozenset({"h264", "hevc", "av1", "mpeg4", "aac", "mp3", "ac3", "eac3", "alac"}),
+    "mov": frozenset({"h264", "hevc", "mpeg4", "prores", "aac", "mp3", "ac3", "alac", "pcm_s16le"}),
+    "webm": frozenset({"vp8", "vp9", "av1", "vorbis", "opus"}),
+    "mkv": None,
+}
+
+# Hardware H.264 encoders in order of preference:
+# (hwaccel name, encoder, input args, output args, device args for the probe encode)
+HWACCEL_PROFILES = [
+    ("cuda", "h264_nvenc",
+     ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"],
+     ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq"],
+     []),
+    ("qsv", "h264_qsv",
+     ["-hwaccel", "qsv"],
+     ["-c:v", "h264_qsv"],
+     []),
+    ("vaapi", "h264_vaapi",
+     ["-hwaccel", "vaapi", "-vaapi_device", "/dev/dri/renderD128"],
+     ["-vf", "format=nv12,hwupload", "-c:v", "h264_vaapi"],
+     ["-vaapi_device", "/dev/dri/renderD128"]),
+]
+# Containers we encode to H.264 (webm only takes VP8/VP9/AV1)
+HWACCEL_TARGETS = frozenset({"mp4", "mkv", "mov"})
+
+# JPEG encoder options passed to poppler for PDF -> jpg
+PDF_JPEG_OPTIONS = "quality=92,progressive=y,optimize=y"
+
+# PDF pages rendered by pdfium are stacked into one image
+PDF_RENDER_DPI = 150
+PDF_RENDER_MAX_PAGES = int(os.getenv("PDF_RENDER_MAX_PAGES", "20"))
+# Tallest image we stack pages into, per output format
+PDF_RENDER_MAX_HEIGHT = {"jpg": 65500, "png": 65500, "webp": 16383}
+
+# Largest image (width * height) we decode; checked from the header before decoding
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "100000000"))
+# Pillow's ICO writer stores at most 256x256
+ICO_MAX_SIZE = (256, 256)
+
+# WebP encoder settings: lossless suits flat-colour screen content such as
+# rendered PDF pages (smaller and faster than lossy there); photos stay lossy
+WEBP_SCREEN_OPTIONS = {"lossless": True, "method": 4, "quality": 90}
+WEBP_PHOTO_OPTIONS = {"method": 4, "quality": 85}
+# RGB images with at most this many distinct colours are treated as screen
+# content (8-bit grayscale never exceeds it, so the check skips those)
+WEBP_SCREEN_MAX_COLORS = 256
+
+# libvips save options for targets it handles; other targets go through Pillow
+VIPS_SAVE_OPTIONS = {
+    "jpg": {"Q": 95, "strip": True},
+    "png": {"strip": True},
+    "tiff": {},
+    "webp": {"Q": WEBP_PHOTO_OPTIONS["quality"], "effort": WEBP_PHOTO_OPTIONS["method"], "strip": True},
+}
+
+# Read/write uploads in 1 MiB chunks so memory stays flat for large files
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Leading bytes kept in memory during upload for magic-number sniffing
+MIME_HEADER_SIZE = 4096
+# Hex digits of the content hash used as the upload's file_id
+FILE_ID_LENGTH = 16
+# Recent upload hashes kept in memory; older ids are rehashed on /convert
+UPLOAD_HASH_CACHE_SIZE = 4096
 
 # Conversion format suggestions per category
 FORMAT_MAP = {
@@ -70,6 +241,12 @@ FORMAT_MAP = {
     "pdf": ["png", "jpg", "jpeg", "webp", "txt"],
 }
 
+MIME_PREFIX_TO_CATEGORY = (
+    ("image/", "image"),
+    ("audio/", "audio"),
+    ("video/", "video"),
+)
+
 MIME_TO_CATEGORY = {
     "image": "image",
     "audio": "audio",
@@ -98,33 +275,237 @@ EXT_TO_CATEGORY = {
     "pdf": "pdf",
 }
 
+# MIME type per known extension, used when the upload itself gives none
+EXT_TO_MIME = {
+    "jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png", "gif": "image/gif",
+    "webp": "image/webp", "tiff": "image/tiff", "tif": "image/tiff", "bmp": "image/bmp",
+    "ico": "image/vnd.microsoft.icon",
+    "mp3": "audio/mpeg", "wav": "audio/x-wav", "ogg": "audio/ogg", "flac": "audio/flac",
+    "aac": "audio/aac", "m4a": "audio/mp4", "wma": "audio/x-ms-wma",
+    "mp4": "video/mp4", "webm": "video/webm", "avi": "video/x-msvideo", "mov": "video/quicktime",
+    "mkv": "video/x-matroska", "wmv": "video/x-ms-wmv", "flv": "video/x-flv",
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "xls": "application/vnd.ms-excel",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "doc": "application/msword", "txt": "text/plain",
+    "odt": "application/vnd.oasis.opendocument.text",
+    "html": "text/html", "rtf": "application/rtf",
+    "pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "ppt": "application/vnd.ms-powerpoint",
+    "odp": "application/vnd.oasis.opendocument.presentation",
+    "pdf": "application/pdf",
+}
+
 EXT_ALIASES = {
     "jpeg": "jpg",
     "tif": "tiff",
 }
 
+# Magic-number signatures. Each pattern is a sequence of byte strings and
+# ints, where an int skips that many bytes (matches anything). Common
+# formats come first; the longest matching signature wins.
+MAGIC_SIGNATURES = [
+    ((b"\xff\xd8\xff",), "image/jpeg"),
+    ((b"\x89PNG\r\n\x1a\n",), "image/png"),
+    ((b"%PDF",), "application/pdf"),
+    ((b"PK\x03\x04",), "application/zip"),
+    ((b"PK\x03\x04", 26, b"mimetypeapplication/vnd.oasis.opendocument.text"),
+     "application/vnd.oasis.opendocument.text"),
+    ((b"PK\x03\x04", 26, b"mimetypeapplication/vnd.oasis.opendocument.spreadsheet"),
+     "application/vnd.oasis.opendocument.spreadsheet"),
+    ((b"PK\x03\x04", 26, b"mimetypeapplication/vnd.oasis.opendocument.presentation"),
+     "application/vnd.oasis.opendocument.presentation"),
+    ((b"GIF87a",), "image/gif"),
+    ((b"GIF89a",), "image/gif"),
+    ((b"RIFF", 4, b"WEBP"), "image/webp"),
+    ((b"II*\x00",), "image/tiff"),
+    ((b"MM\x00*",), "image/tiff"),
+    ((b"BM",), "image/bmp"),
+    ((b"\x00\x00\x01\x00",), "image/x-icon"),
+    ((b"ID3",), "audio/mpeg"),
+    ((b"\xff\xfb",), "audio/mpeg"),
+    ((b"\xff\xf3",), "audio/mpeg"),
+    ((b"\xff\xf2",), "audio/mpeg"),
+    ((b"\xff\xf1",), "audio/aac"),
+    ((b"\xff\xf9",), "audio/aac"),
+    ((b"OggS",), "audio/ogg"),
+    ((b"fLaC",), "audio/x-flac"),
+    ((b"RIFF", 4, b"WAVE"), "audio/x-wav"),
+    ((b"RIFF", 4, b"AVI "), "video/x-msvideo"),
+    ((4, b"ftyp"), "video/mp4"),
+    ((4, b"ftypM4A "), "audio/mp4"),
+    ((4, b"ftypqt  "), "video/quicktime"),
+    ((4, b"ftypheic"), "image/heic"),
+    ((4, b"ftypheix"), "image/heic"),
+    ((4, b"ftypmif1"), "image/heic"),
+    ((4, b"ftypavif"), "image/avif"),
+    ((b"\x1a\x45\xdf\xa3",), "video/x-matroska"),
+    ((b"\x30\x26\xb2\x75\x8e\x66\xcf\x11",), "video/x-ms-wmv"),
+    ((b"FLV\x01",), "video/x-flv"),
+    ((b"{\\rtf",), "application/rtf"),
+]
+
+# OOXML files are plain ZIPs; the first entry names reveal the flavour
+OOXML_MARKERS = (
+    (b"word/", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+    (b"xl/", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    (b"ppt/", "application/vnd.openxmlformats-officedocument.presentationml.presentation"),
+)
+
+_TRIE_ANY = -1
+_TRIE_MIME = -2
+
+
+def _build_magic_trie(signatures) -> dict:
+    trie: dict = {}
+    for pattern, mime in signatures:
+        node = trie
+        for part in pattern:
+            keys = [_TRIE_ANY] * part if isinstance(part, int) else part
+            for key in keys:
+                node = node.setdefault(key, {})
+        node[_TRIE_MIME] = mime
+    return trie
+
+
+MAGIC_TRIE = _build_magic_trie(MAGIC_SIGNATURES)
+
+
+def _ext(name: str) -> str:
+    # Same result as Path(name).suffix.lstrip(".").lower() without building a Path
+    stem, dot, ext = name.rpartition("/")[2].rpartition(".")
+    return ext.lower() if dot and stem else ""
+
+
+def upload_path(file_id: str, ext: str) -> Path:
+    return UPLOAD_DIR / (f"{file_id}.{ext}" if ext else file_id)
+
 
 def normalize_ext(ext: str) -> str:
     clean = ext.lower().lstrip(".")
     return EXT_ALIASES.get(clean, clean)
 
 
-def detect_category(filename: str, mime: Optional[str]) -> str:
-    ext = Path(filename).suffix.lstrip(".").lower()
+def _build_suggestions(format_map: dict) -> dict:
+    suggestions = {}
+    for category, fmts in format_map.items():
+        for input_ext in {normalize_ext(fmt) for fmt in fmts}:
+            suggestions[(category, input_ext)] = tuple(
+                fmt for fmt in fmts if normalize_ext(fmt) != input_ext
+            )
+    return suggestions
+
+
+# Suggestions with the input format removed, keyed by (category, normalized input ext)
+SUGGESTIONS = _build_suggestions(FORMAT_MAP)
+FORMAT_MAP_DEFAULT = {category: tuple(fmts) for category, fmts in FORMAT_MAP.items()}
+ALLOWED_TARGETS = {
+    category: frozenset(normalize_ext(fmt) for fmt in fmts)
+    for category, fmts in FORMAT_MAP.items()
+}
+
+
+def _match_magic(node: dict, header: bytes, pos: int) -> Optional[str]:
+    if pos < len(header):
+        child = node.get(header[pos])
+        if child is not None:
+            found = _match_magic(child, header, pos + 1)
+            if found:
+                return found
+        child = node.get(_TRIE_ANY)
+        if child is not None:
+            found = _match_magic(child, header, pos + 1)
+            if found:
+                return found
+    return node.get(_TRIE_MIME)
+
+
+def detect_mime(header: bytes) -> Optional[str]:
+    mime = _match_magic(MAGIC_TRIE, header, 0)
+    if mime == "application/zip":
+        for marker, ooxml_mime in OOXML_MARKERS:
+            if marker in header:
+                return ooxml_mime
+    if mime == "video/x-matroska" and b"webm" in header[:64]:
+        return "video/webm"
+    return mime
+
+
+@lru_cache(maxsize=4096)
+def detect_category(ext: str, mime: Optional[str]) -> str:
     if ext in EXT_TO_CATEGORY:
         return EXT_TO_CATEGORY[ext]
     if mime:
-        if mime.startswith("image/"):
-            return "image"
-        if mime.startswith("audio/"):
-            return "audio"
-        if mime.startswith("video/"):
-            return "video"
+        for prefix, category in MIME_PREFIX_TO_CATEGORY:
+            if mime.startswith(prefix):
+                return category
         if mime in MIME_TO_CATEGORY:
             return MIME_TO_CATEGORY[mime]
     return "unknown"
 
 
+# Content hash of recent uploads (LRU), used to key the conversion cache
+upload_hashes: "OrderedDict[str, str]" = OrderedDict()
+
+
+def remember_upload_hash(file_id: str, content_hash: str):
+    upload_hashes[file_id] = content_hash
+    upload_hashes.move_to_end(file_id)
+    while len(upload_hashes) > UPLOAD_HASH_CACHE_SIZE:
+        upload_hashes.popitem(last=False)
+
+
+def new_content_hasher():
+    return blake3() if HAS_BLAKE3 else hashlib.sha256()
+
+
+def hash_file(path: Path) -> str:
+    if HAS_BLAKE3:
+        hasher = blake3(max_threads=blake3.AUTO)
+        hasher.update_mmap(str(path))
+        return hasher.hexdigest()
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _sendfile_upload(src_fd: int, dst: Path) -> Tuple[bytes, str]:
+    header = os.pread(src_fd, MIME_HEADER_SIZE, 0)
+    size = os.fstat(src_fd).st_size
+    with open(dst, "wb") as f:
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(f.fileno(), src_fd, offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    return header, hash_file(dst)
+
+
+async def save_upload(file: UploadFile, dst: Path) -> Tuple[bytes, str]:
+    """Write an upload to dst and return its leading bytes and content hash."""
+    src = file.file
+    # Large uploads are already spooled to a real temp file; copy those in the kernel
+    if hasattr(os, "sendfile") and isinstance(src, tempfile.SpooledTemporaryFile) and src._rolled:
+        try:
+            return await run_in_threadpool(_sendfile_upload, src.fileno(), dst)
+        except OSError:
+            await file.seek(0)
+
+    header = bytearray()
+    hasher = new_content_hasher()
+    async with aiofiles.open(dst, "wb") as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            if len(header) < MIME_HEADER_SIZE:
+                header += chunk[:MIME_HEADER_SIZE - len(header)]
+            hasher.update(chunk)
+            await f.write(chunk)
+    return bytes(header), hasher.hexdigest()
+
+
 class UploadResponse(BaseModel):
     file_id: str
     filename: str
@@ -152,117 +533,358 @@ async def health():
 
 @app.post("/upload", response_model=UploadResponse)
 async def upload_file(file: UploadFile = File(...)):
-    file_id = str(uuid.uuid4())
-    ext = Path(file.filename).suffix
-    save_path = UPLOAD_DIR / f"{file_id}{ext}"
+    ext = _ext(file.filename)
 
-    with open(save_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    # Sniff, hash and save in one pass, then name the upload after its content
+    tmp_path = UPLOAD_DIR / f"{uuid.uuid4()}.part"
+    try:
+        header, content_hash = await save_upload(file, tmp_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    file_id = content_hash[:FILE_ID_LENGTH]
+    os.replace(tmp_path, upload_path(file_id, ext))
+    remember_upload_hash(file_id, content_hash)
 
     # Detect MIME
     mime = file.content_type or ""
-    if HAS_FILETYPE:
-        kind = filetype.guess(str(save_path))
-        if kind:
-            mime = kind.mime
+    sniffed = detect_mime(header)
+    if sniffed:
+        mime = sniffed
 
     if not mime or mime == "application/octet-stream":
-        guessed, _ = mimetypes.guess_type(file.filename)
-        if guessed:
-            mime = guessed
+        mime = EXT_TO_MIME.get(ext, mime)
 
-    category = detect_category(file.filename, mime)
-    suggestions = FORMAT_MAP.get(category, [])
+    category = detect_category(ext, mime)
 
-    # Remove same format as input
-    input_ext = normalize_ext(Path(file.filename).suffix.lstrip("."))
-    suggestions = [s for s in suggestions if normalize_ext(s) != input_ext]
+    # Suggestions exclude the input format
+    input_ext = normalize_ext(ext)
+    suggestions = SUGGESTIONS.get((category, input_ext), FORMAT_MAP_DEFAULT.get(category, ()))
 
     return UploadResponse(
         file_id=file_id,
         filename=file.filename,
         category=category,
         mime_type=mime,
-        suggestions=suggestions,
+        suggestions=list(suggestions),
     )
 
 
 @app.post("/convert")
 async def convert_file(req: ConvertRequest):
     # Find uploaded file
-    input_ext = Path(req.filename).suffix
-    input_path = UPLOAD_DIR / f"{req.file_id}{input_ext}"
+    input_ext = _ext(req.filename)
+    input_path = upload_path(req.file_id, input_ext)
 
     if not input_path.exists():
         raise HTTPException(status_code=404, detail="Upload not found")
 
-    category = detect_category(req.filename, None)
+    category = detect_category(input_ext, None)
     target_raw = req.target_format.lower().lstrip(".")
     target = normalize_ext(target_raw)
     output_ext = target_raw
     output_filename = Path(req.filename).stem + f".{output_ext}"
     output_path = OUTPUT_DIR / f"{req.file_id}_{output_filename}"
 
-    allowed_targets = {normalize_ext(fmt) for fmt in FORMAT_MAP.get(category, [])}
-    if target not in allowed_targets:
+    if target not in ALLOWED_TARGETS.get(category, ()):
         raise HTTPException(
             status_code=400,
             detail=f"Target .{target_raw} is not supported for {category}",
         )
 
+    # Identical content converted to the same target before is served from cache
+    content_hash = upload_hashes.get(req.file_id)
+    if content_hash is None:
+        content_hash = await run_in_threadpool(hash_file, input_path)
+    remember_upload_hash(req.file_id, content_hash)
+    cache_path = CACHE_DIR / f"{content_hash}_{category}.{target}"
+    if cache_path.exists():
+        return download_response(cache_path, output_filename)
+
+    # file_ids repeat for identical content, so each request converts into its
+    # own file and only moves a finished result into place
+    work_path = OUTPUT_DIR / f"{uuid.uuid4()}.part.{output_ext}"
     try:
         if category == "image":
-            convert_image(input_path, output_path, target)
+            await run_conversion(convert_image, input_path, work_path, target)
         elif category in ("audio", "video"):
-            convert_media(input_path, output_path, target)
+            await convert_media(input_path, work_path, target)
         elif category == "spreadsheet":
-            convert_spreadsheet(input_path, output_path, target)
+            if target == "pdf":
+                await convert_office(input_path, work_path, target)
+            else:
+                await run_conversion(convert_spreadsheet, input_path, work_path, target)
         elif category in ("document", "presentation"):
-            convert_office(input_path, output_path, target)
+            await convert_office(input_path, work_path, target)
         elif category == "pdf":
-            convert_pdf(input_path, output_path, target)
+            await run_conversion(convert_pdf, input_path, work_path, target)
         else:
             raise HTTPException(status_code=400, detail=f"Unsupported category: {category}")
+        if not work_path.exists():
+            raise HTTPException(status_code=500, detail="Conversion produced no output file")
+        os.replace(work_path, output_path)
     except HTTPException:
         raise
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Conversion failed: {str(e)}")
+    finally:
+        work_path.unlink(missing_ok=True)
+
+    try:
+        os.link(output_path, cache_path)
+    except OSError:
+        pass  # already cached by a concurrent request, or links unsupported
 
-    if not output_path.exists():
-        raise HTTPException(status_code=500, detail="Conversion produced no output file")
+    return download_response(output_path, output_filename)
 
-    return FileResponse(
-        path=str(output_path),
-        filename=output_filename,
+
+def download_response(path: Path, filename: str) -> Response:
+    if not USE_XACCEL:
+        return FileResponse(
+            path=str(path),
+            filename=filename,
+            media_type="application/octet-stream",
+        )
+    quoted = quote(filename)
+    if quoted != filename:
+        disposition = f"attachment; filename*=utf-8''{quoted}"
+    else:
+        disposition = f'attachment; filename="{filename}"'
+    return Response(
         media_type="application/octet-stream",
+        headers={
+            "X-Accel-Redirect": XACCEL_PREFIX + quote(path.relative_to(OUTPUT_DIR).as_posix()),
+            "Content-Disposition": disposition,
+        },
     )
 
 
+conversion_pool: Optional[ProcessPoolExecutor] = None
+conversion_pool_lock = asyncio.Lock()
+
+
+def start_conversion_pool():
+    global conversion_pool
+    if CONVERSION_WORKERS > 0:
+        # spawn: forking a process that already runs the event loop and
+        # native thread pools (libvips, pdfium) is not safe
+        conversion_pool = ProcessPoolExecutor(
+            max_workers=CONVERSION_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+
+
+def stop_conversion_pool():
+    global conversion_pool
+    if conversion_pool is not None:
+        conversion_pool.shutdown(cancel_futures=True)
+        conversion_pool = None
+
+
+async def replace_conversion_pool(broken: ProcessPoolExecutor):
+    global conversion_pool
+    async with conversion_pool_lock:
+        # Another request may already have replaced it
+        if conversion_pool is not broken:
+            return
+        logger.warning("Conversion worker died; starting a new process pool")
+        broken.shutdown(wait=False, cancel_futures=True)
+        conversion_pool = None
+        start_conversion_pool()
+
+
+async def run_conversion(func, *args):
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = conversion_pool
+        if pool is None:
+            return await run_in_threadpool(func, *args)
+        try:
+            return await loop.run_in_executor(pool, func, *args)
+        except BrokenProcessPool:
+            # A crashed worker (OOM kill, segfault in a native library)
+            # breaks the whole pool; replace it and retry once
+            await replace_conversion_pool(pool)
+    raise RuntimeError("Conversion worker crashed")
+
+
+async def run_command(cmd: List[str], timeout: int, name: str):
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        _, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise RuntimeError(f"{name} timed out")
+    if proc.returncode != 0:
+        raise RuntimeError(f"{name} error: {stderr.decode(errors='replace')[-500:]}")
+
+
+class ImageTooLargeError(RuntimeError):
+    pass
+
+
+def check_image_size(width: int, height: int):
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ImageTooLargeError(
+            f"Image too large: {width}x{height} exceeds {MAX_IMAGE_PIXELS} pixels"
+        )
+
+
+def flatten_on_white(img):
+    """Composite transparent pixels onto white for formats without alpha."""
+    if img.mode == "P":
+        img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+    if img.mode in ("RGBA", "LA"):
+        background = Image.new("RGB", img.size, "white")
+        background.paste(img.convert("RGBA"), mask=img.getchannel("A"))
+        return background
+    return img
+
+
+def convert_image_with_vips(src: Path, dst: Path, target: str) -> bool:
+    # WebP from anything but JPEG may be screen content, which Pillow saves losslessly
+    if target == "webp" and normalize_ext(src.suffix) != "jpg":
+        return False
+    try:
+        img = pyvips.Image.new_from_file(str(src), access="sequential")
+        check_image_size(img.width, img.height)
+        if target == "jpg" and img.hasalpha():
+            # Composite onto white, as the Pillow path does
+            img = img.flatten(background=[255] * (img.bands - 1))
+        img.write_to_file(str(dst), **VIPS_SAVE_OPTIONS[target])
+        return True
+    except pyvips.Error:
+        return False
+
+
 def convert_image(src: Path, dst: Path, target: str):
+    if HAS_VIPS and target in VIPS_SAVE_OPTIONS and convert_image_with_vips(src, dst, target):
+        return
     if not HAS_PILLOW:
         raise RuntimeError("Pillow not installed")
     img = Image.open(src)
+    check_image_size(*img.size)
     if target == "jpg":
-        if img.mode in ("RGBA", "LA", "P"):
-            img = img.convert("RGB")
-        img.save(dst, "JPEG", quality=95)
+        flatten_on_white(img).save(dst, "JPEG", quality=95)
     elif target == "pdf":
-        if img.mode in ("RGBA", "LA", "P"):
-            img = img.convert("RGB")
-        img.save(dst, "PDF")
+        flatten_on_white(img).save(dst, "PDF")
+    elif target == "webp":
+        if img.mode in ("P", "1") or (
+            img.mode in ("RGB", "RGBA") and img.getcolors(WEBP_SCREEN_MAX_COLORS) is not None
+        ):
+            img.save(dst, "WEBP", **WEBP_SCREEN_OPTIONS)
+        else:
+            img.save(dst, "WEBP", **WEBP_PHOTO_OPTIONS)
     else:
+        if target == "ico":
+            # JPEG sources decode straight at a reduced scale (no-op for other formats)
+            img.draft("RGB", ICO_MAX_SIZE)
         fmt_map = {"webp": "WEBP", "png": "PNG", "tiff": "TIFF", "bmp": "BMP", "gif": "GIF", "ico": "ICO"}
         fmt = fmt_map.get(target, target.upper())
         img.save(dst, fmt)
 
 
-def convert_media(src: Path, dst: Path, target: str):
-    result = subprocess.run(
-        ["ffmpeg", "-y", "-i", str(src), str(dst)],
-        capture_output=True, text=True, timeout=300
-    )
+@lru_cache(maxsize=256)
+def probe_codecs(path: str) -> Tuple[str, ...]:
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "stream=codec_type,codec_name",
+             "-of", "json", path],
+            capture_output=True, text=True, timeout=30
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return ()
     if result.returncode != 0:
-        raise RuntimeError(f"ffmpeg error: {result.stderr[-500:]}")
+        return ()
+    streams = json.loads(result.stdout or "{}").get("streams", [])
+    return tuple(
+        s.get("codec_name", "") for s in streams if s.get("codec_type") in ("video", "audio")
+    )
+
+
+def _can_remux(src_ext: str, target_ext: str) -> bool:
+    return (src_ext, target_ext) in REMUX_PAIRS
+
+
+async def run_ffmpeg(cmd: List[str]):
+    async with media_semaphore:
+        await run_command(cmd, 300, "ffmpeg")
+
+
+video_hwaccel: Optional[tuple] = None
+
+
+def detect_hwaccel():
+    global video_hwaccel
+    video_hwaccel = None
+    if os.getenv("DISABLE_HWACCEL") == "1":
+        return
+    try:
+        hwaccels = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-hwaccels"], capture_output=True, text=True, timeout=10
+        ).stdout.split()
+        encoders = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=10
+        ).stdout.split()
+    except (OSError, subprocess.TimeoutExpired):
+        return
+    for profile in HWACCEL_PROFILES:
+        name, encoder = profile[0], profile[1]
+        if name in hwaccels and encoder in encoders and _probe_hw_encoder(profile):
+            video_hwaccel = profile
+            return
+
+
+def _probe_hw_encoder(profile) -> bool:
+    # Builds list NVENC/QSV/VAAPI even without the hardware; a tiny test
+    # encode shows whether a device is actually usable
+    _, _, _, output_args, device_args = profile
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-v", "error", *device_args,
+             "-f", "lavfi", "-i", "nullsrc=s=256x256:d=0.1",
+             *output_args, "-f", "null", "-"],
+            capture_output=True, timeout=15,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0
+
+
+async def convert_media(src: Path, dst: Path, target: str):
+    src_ext = normalize_ext(src.suffix)
+    if _can_remux(src_ext, target):
+        codecs = await run_in_threadpool(probe_codecs, str(src))
+        allowed = REMUX_CODECS.get(target)
+        if codecs and (allowed is None or all(c in allowed for c in codecs)):
+            try:
+                await run_ffmpeg(["ffmpeg", "-hide_banner", "-y", "-nostdin", "-i", str(src),
+                                  "-c", "copy", "-sn", "-dn", str(dst)])
+                return
+            except RuntimeError:
+                pass  # fall back to a full transcode
+
+    hwaccel = video_hwaccel
+    if hwaccel and target in HWACCEL_TARGETS and EXT_TO_CATEGORY.get(src_ext) == "video":
+        _, _, input_args, output_args, _ = hwaccel
+        try:
+            await run_ffmpeg(["ffmpeg", "-hide_banner", "-y", "-nostdin", *input_args,
+                              "-i", str(src), *output_args, str(dst)])
+            return
+        except RuntimeError:
+            pass  # no usable GPU at runtime, encode in software
+
+    cmd = ["ffmpeg", "-hide_banner", "-y", "-nostdin", "-i", str(src), "-threads", "0"]
+    cmd += MEDIA_CODEC_ARGS.get(target, [])
+    cmd.append(str(dst))
+    await run_ffmpeg(cmd)
 
 
 def convert_spreadsheet(src: Path, dst: Path, target: str):
@@ -270,54 +892,191 @@ def convert_spreadsheet(src: Path, dst: Path, target: str):
         raise RuntimeError("pandas not installed")
     ext = src.suffix.lower()
     if ext == ".csv":
-        df = pd.read_csv(src)
+        df = pd.read_csv(src, engine="pyarrow") if HAS_PYARROW else pd.read_csv(src)
     else:
-        df = pd.read_excel(src)
+        df = pd.read_excel(src, engine="calamine") if HAS_CALAMINE else pd.read_excel(src)
 
     if target == "csv":
         df.to_csv(dst, index=False)
     elif target == "xlsx":
-        df.to_excel(dst, index=False)
-    elif target == "pdf":
-        convert_office(src, dst, "pdf")
+        df.to_excel(dst, index=False, engine="xlsxwriter" if HAS_XLSXWRITER else None)
     else:
         raise RuntimeError(f"Unsupported spreadsheet target: {target}")
 
 
-def convert_office(src: Path, dst: Path, target: str):
+office_servers: Dict[int, subprocess.Popen] = {}
+office_started: Dict[int, float] = {}
+office_ports: Optional[asyncio.Queue] = None
+office_slot_lock = None
+
+
+def _claim_office_slot() -> Optional[int]:
+    global office_slot_lock
+    if fcntl is None:
+        return 0
+    for slot in range(OFFICE_MAX_SLOTS):
+        lock_path = Path(tempfile.gettempdir()) / f"flux-office-{UNOSERVER_BASE_PORT}-{slot}.lock"
+        lock_file = open(lock_path, "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        # Held until this process exits; the kernel releases it even on a crash
+        office_slot_lock = lock_file
+        return slot
+    return None
+
+
+def _office_log_path(port: int) -> Path:
+    return Path(tempfile.gettempdir()) / f"flux-unoserver-{port}.log"
+
+
+def start_office_servers():
+    global office_ports
+    if not HAS_UNOSERVER or LIBREOFFICE_INSTANCES < 1 or not shutil.which("unoserver"):
+        return
+    slot = _claim_office_slot()
+    if slot is None:
+        logger.error("No free LibreOffice port slot; using one-shot LibreOffice conversions")
+        return
+    office_ports = asyncio.Queue()
+    for i in range(LIBREOFFICE_INSTANCES):
+        port = UNOSERVER_BASE_PORT + 2 * (slot * LIBREOFFICE_INSTANCES + i)
+        _spawn_office_server(port)
+        office_ports.put_nowait(port)
+
+
+def _spawn_office_server(port: int):
+    with open(_office_log_path(port), "wb") as log:
+        office_servers[port] = subprocess.Popen(
+            ["unoserver", "--interface", "127.0.0.1", "--port", str(port),
+             "--uno-interface", "127.0.0.1", "--uno-port", str(port - 1),
+             "--conversion-timeout", str(OFFICE_CONVERSION_TIMEOUT)],
+            stdout=subprocess.DEVNULL, stderr=log,
+        )
+    office_started[port] = time.monotonic()
+
+
+def _office_server_alive(port: int) -> bool:
+    proc = office_servers.get(port)
+    if proc is None:
+        return False  # gave up on this server
+    if proc.poll() is None:
+        return True
+    try:
+        tail = _office_log_path(port).read_text(errors="replace")[-500:]
+    except OSError:
+        tail = ""
+    if time.monotonic() - office_started[port] < OFFICE_MIN_UPTIME:
+        del office_servers[port]
+        logger.error(
+            "unoserver on port %d exited with status %d right after starting, "
+            "falling back to one-shot LibreOffice: %s",
+            port, proc.returncode, tail,
+        )
+    else:
+        # Crashed or hit --conversion-timeout; this request uses the one-shot
+        # fallback while the new server starts up
+        logger.warning(
+            "unoserver on port %d exited with status %d, restarting it: %s",
+            port, proc.returncode, tail,
+        )
+        _spawn_office_server(port)
+    return False
+
+
+def _restart_office_server(port: int):
+    proc = office_servers.get(port)
+    if proc is None:
+        return
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    _spawn_office_server(port)
+
+
+def stop_office_servers():
+    global office_ports, office_slot_lock
+    office_ports = None
+    for proc in office_servers.values():
+        proc.terminate()
+    for proc in office_servers.values():
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    office_servers.clear()
+    office_started.clear()
+    if office_slot_lock is not None:
+        office_slot_lock.close()
+        office_slot_lock = None
+
+
+async def convert_office(src: Path, dst: Path, target: str):
     fmt_map = {
         "pdf": "pdf", "txt": "txt", "odt": "odt",
         "docx": "docx", "html": "html", "odp": "odp",
         "pptx": "pptx", "csv": "csv", "xlsx": "xlsx",
     }
     lo_format = fmt_map.get(target, target)
-    result = subprocess.run(
-        ["libreoffice", "--headless", "--convert-to", lo_format,
-         "--outdir", str(dst.parent), str(src)],
-        capture_output=True, text=True, timeout=120
-    )
-    if result.returncode != 0:
-        raise RuntimeError(f"LibreOffice error: {result.stderr[-500:]}")
 
-    # LibreOffice names output based on input stem
-    expected = dst.parent / (src.stem + f".{lo_format}")
-    if expected.exists() and expected != dst:
-        expected.rename(dst)
+    # Each LibreOffice instance handles one conversion at a time
+    ports = office_ports
+    if ports is not None:
+        port = await ports.get()
+        try:
+            if _office_server_alive(port):
+                client = UnoClient(server="127.0.0.1", port=str(port))
+                # Backstop for unoserver's own --conversion-timeout
+                await asyncio.wait_for(
+                    run_in_threadpool(
+                        client.convert, inpath=str(src), outpath=str(dst), convert_to=lo_format
+                    ),
+                    OFFICE_CONVERSION_TIMEOUT + 10,
+                )
+                return
+        except asyncio.TimeoutError:
+            logger.error("unoserver on port %d hung on a conversion, restarting it", port)
+            await run_in_threadpool(_restart_office_server, port)
+            raise RuntimeError(f"LibreOffice timed out after {OFFICE_CONVERSION_TIMEOUT}s")
+        except ConnectionError as e:
+            logger.warning("unoserver on port %d unreachable (%s), using one-shot LibreOffice", port, e)
+        finally:
+            ports.put_nowait(port)
+
+    # LibreOffice names output after the input stem, which concurrent requests
+    # for the same upload share, so give each run its own outdir. Runs sharing
+    # a user profile hand their job to the first instance and exit without
+    # output, so each one also gets a private profile.
+    with tempfile.TemporaryDirectory(dir=dst.parent) as outdir:
+        profile = (Path(outdir).resolve() / "profile").as_uri()
+        await run_command(
+            ["libreoffice", f"-env:UserInstallation={profile}", "--headless",
+             "--convert-to", lo_format, "--outdir", outdir, str(src)],
+            OFFICE_CONVERSION_TIMEOUT, "LibreOffice",
+        )
+        expected = Path(outdir) / (src.stem + f".{lo_format}")
+        if expected.exists():
+            expected.replace(dst)
 
 
 def convert_pdf(src: Path, dst: Path, target: str):
-    if target in ("png", "jpg"):
+    if target in ("png", "jpg", "webp"):
+        # Every backend stacks the same pages at the same resolution
+        if convert_pdf_with_fitz(src, dst, target):
+            return
         if convert_pdf_with_poppler(src, dst, target):
             return
         if convert_pdf_with_pdfium(src, dst, target):
             return
         raise RuntimeError(
-            "No PDF-to-image backend available. Install poppler (pdftoppm) or pypdfium2."
+            "No PDF-to-image backend available. "
+            "Install PyMuPDF, poppler (pdftocairo/pdftoppm) or pypdfium2."
         )
-    elif target == "webp":
-        if convert_pdf_with_pdfium(src, dst, target):
-            return
-        raise RuntimeError("PDF to WEBP requires pypdfium2.")
     elif target == "txt":
         result = subprocess.run(
             ["pdftotext", str(src), str(dst)],
@@ -329,17 +1088,110 @@ def convert_pdf(src: Path, dst: Path, target: str):
         raise RuntimeError(f"Unsupported PDF target: {target}")
 
 
-def convert_pdf_with_poppler(src: Path, dst: Path, target: str) -> bool:
+def _pdf_pages_that_fit(heights: List[int], target: str) -> int:
+    """Number of leading pages to stack, given their rendered heights."""
+    max_height = PDF_RENDER_MAX_HEIGHT.get(target, 65500)
+    count, total = 0, 0
+    for height in heights[:PDF_RENDER_MAX_PAGES]:
+        if count and total + height > max_height:
+            break
+        count += 1
+        total += height
+    return count
+
+
+def _stack_pages(images: list):
+    if len(images) == 1:
+        return images[0]
+    width = max(img.width for img in images)
+    canvas = Image.new("RGB", (width, sum(img.height for img in images)), "white")
+    y = 0
+    for img in images:
+        canvas.paste(img, (0, y))
+        y += img.height
+    return canvas
+
+
+def _save_pdf_render(pil_image, dst: Path, target: str):
+    if target == "jpg":
+        if pil_image.mode in ("RGBA", "LA", "P"):
+            pil_image = pil_image.convert("RGB")
+        pil_image.save(dst, "JPEG", quality=92)
+    elif target == "png":
+        pil_image.save(dst, "PNG")
+    else:
+        pil_image.save(dst, "WEBP", **WEBP_SCREEN_OPTIONS)
+
+
+def _pdf_page_count(src: Path) -> Optional[int]:
+    if not HAS_PDFIUM:
+        return None
     try:
-        poppler_target = "jpeg" if target == "jpg" else target
-        prefix = dst.parent / dst.stem
-        result = subprocess.run(
-            ["pdftoppm", "-r", "150", "-singlefile", f"-{poppler_target}", str(src), str(prefix)],
-            capture_output=True,
-            text=True,
-            timeout=60,
+        pdf = pdfium.PdfDocument(str(src))
+    except Exception:
+        return None
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def convert_pdf_with_fitz(src: Path, dst: Path, target: str) -> bool:
+    if not HAS_FITZ:
+        return False
+    doc = None
+    try:
+        doc = fitz.open(str(src))
+        if doc.page_count == 0:
+            return False
+        zoom = PDF_RENDER_DPI / 72
+        count = _pdf_pages_that_fit(
+            [int(doc[i].rect.height * zoom) for i in range(min(doc.page_count, PDF_RENDER_MAX_PAGES))],
+            target,
         )
-        if result.returncode != 0:
+        pixmaps = [doc[i].get_pixmap(dpi=PDF_RENDER_DPI, colorspace=fitz.csRGB) for i in range(count)]
+        if count == 1 and target in ("png", "jpg"):
+            # MuPDF encodes PNG/JPEG itself, no PIL round-trip
+            if target == "jpg":
+                pixmaps[0].save(str(dst), output="jpg", jpg_quality=92)
+            else:
+                pixmaps[0].save(str(dst), output="png")
+        else:
+            images = [Image.frombytes("RGB", (pix.width, pix.height), pix.samples) for pix in pixmaps]
+            _save_pdf_render(_stack_pages(images), dst, target)
+        return True
+    except Exception:
+        return False
+    finally:
+        if doc is not None:
+            doc.close()
+
+
+def _run_poppler(options: List[str], src: Path, prefix: Path) -> bool:
+    # pdftocairo's Cairo backend is faster than pdftoppm's Splash on text-heavy pages
+    for tool in ("pdftocairo", "pdftoppm"):
+        try:
+            result = subprocess.run(
+                [tool, "-r", str(PDF_RENDER_DPI), *options, str(src), str(prefix)],
+                capture_output=True,
+                text=True,
+                timeout=60,
+            )
+        except FileNotFoundError:
+            continue
+        if result.returncode == 0:
+            return True
+    return False
+
+
+def convert_pdf_with_poppler(src: Path, dst: Path, target: str) -> bool:
+    prefix = dst.parent / dst.stem
+    if target in ("png", "jpg") and _pdf_page_count(src) == 1:
+        poppler_target = "jpeg" if target == "jpg" else target
+        options = ["-singlefile", f"-{poppler_target}"]
+        if poppler_target == "jpeg":
+            options += ["-jpegopt", PDF_JPEG_OPTIONS]
+        if not _run_poppler(options, src, prefix):
             return False
         candidates = [dst.parent / f"{dst.stem}.{target}"]
         if target == "jpg":
@@ -349,9 +1201,26 @@ def convert_pdf_with_poppler(src: Path, dst: Path, target: str) -> bool:
                 if candidate != dst:
                     candidate.replace(dst)
                 return True
-    except FileNotFoundError:
         return False
-    return False
+
+    # Several pages (or unknown): render lossless PNG pages, then stack them
+    if not _run_poppler(["-png", "-f", "1", "-l", str(PDF_RENDER_MAX_PAGES)], src, prefix):
+        return False
+    pages = sorted(
+        (p for p in dst.parent.glob(f"{glob_escape(dst.stem)}-*.png")
+         if p.stem[len(dst.stem) + 1:].isdigit()),
+        key=lambda p: int(p.stem[len(dst.stem) + 1:]),
+    )
+    try:
+        if not pages:
+            return False
+        images = [Image.open(p) for p in pages]
+        count = _pdf_pages_that_fit([img.height for img in images], target)
+        _save_pdf_render(_stack_pages(images[:count]), dst, target)
+        return True
+    finally:
+        for p in pages:
+            p.unlink(missing_ok=True)
 
 
 def convert_pdf_with_pdfium(src: Path, dst: Path, target: str) -> bool:
@@ -362,18 +1231,14 @@ def convert_pdf_with_pdfium(src: Path, dst: Path, target: str) -> bool:
         pdf = pdfium.PdfDocument(str(src))
         if len(pdf) == 0:
             raise RuntimeError("PDF has no pages")
-        page = pdf[0]
-        pil_image = page.render(scale=2).to_pil()
-        if target == "jpg":
-            if pil_image.mode in ("RGBA", "LA", "P"):
-                pil_image = pil_image.convert("RGB")
-            pil_image.save(dst, "JPEG", quality=92)
-        elif target == "png":
-            pil_image.save(dst, "PNG")
-        elif target == "webp":
-            pil_image.save(dst, "WEBP", quality=90)
-        else:
-            return False
+        scale = PDF_RENDER_DPI / 72
+        count = _pdf_pages_that_fit(
+            [int(pdf.get_page_size(i)[1] * scale) for i in range(min(len(pdf), PDF_RENDER_MAX_PAGES))],
+            target,
+        )
+        # Serial on purpose: this already runs in a conversion-pool worker
+        images = [pdf[i].render(scale=scale).to_pil() for i in range(count)]
+        _save_pdf_render(_stack_pages(images), dst, target)
         return True
     except Exception:
         return False